@@ -18,9 +18,14 @@ try:
 except ImportError:
     import sparql
     
+import copy
 import httplib2
 import urllib
 import socket
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
 
 import rdfmarshal.instance as instance
 import rdfmarshal.base as base
@@ -34,6 +39,11 @@ from pyom import miroop
 from pyom.log import log_info, log_debug, log_error, StdOutLogger
 from pyom.log import error_description, safe_str
 
+# How many built SPARQL queries an OM2 instance keeps around
+QUERY_CACHE_SIZE = 256
+# How many NeoRepo answers an OM2 instance keeps around when cache_ttl is set
+RESPONSE_CACHE_SIZE = 1024
+
 #class Entity(instance.Base):
 #     """Base does everything Entity is supposed to do."""
 
@@ -42,28 +52,49 @@ class UpdateError(Exception):
     
 class WrongTypeOfObject(Exception):
     pass
+    
+class MissingUriRefError(ValueError):
+    pass
+    
+class MismatchedUriRefError(ValueError):
+    pass
+    
+class TypeMismatchError(ValueError):
+    pass
 
-def fullname_from_ontology( ontology, ref):
+def fullname_from_ontology( ontology, ref, cache=None):
     """ Return the full name for property or list of properties given
     that they belong to a specific ontology.
     
     :param ontology: The python ontology module
     :param ref: A property name or a list of property names
+    :param cache: None or a dictionary where full names are remembered by
+        (ontology, property name), every OM2 instance keeps one.
     :return: The full name for the given property/properties.
     """
+    if cache is None:
+        cache = {}
     
     if isinstance(ref, list):
-        return [str(ontology.PropertyFactory(p).type) \
-                    for p in ref]
+        return [_fullname(ontology, p, cache) for p in ref]
     elif isinstance(ref, dict):
-        return dict([(str(ontology.PropertyFactory(p).type), v) \
-                    for p, v in ref.items()])
+        return {_fullname(ontology, p, cache): v for p, v in ref.items()}
     else:
-        return str(ontology.PropertyFactory(ref).type)
+        return _fullname(ontology, ref, cache)
+
+def _fullname(ontology, prop, cache):
+    try:
+        return cache[(ontology, prop)]
+    except KeyError:
+        res = cache[(ontology, prop)] = \
+                str(ontology.PropertyFactory(prop).type)
+        return res
 
-def name_arr(props, ont):
+def name_arr(props, ont, cache=None):
     #may throw an exception
-    return [split_uri(unicode(fullname_from_ontology(ont, prop))) \
+    if cache is None:
+        cache = {}
+    return [split_uri(unicode(fullname_from_ontology(ont, prop, cache))) \
                 for prop in props]
 
 def unfurl(obj):
@@ -77,22 +108,22 @@ def unfurl(obj):
     if not isinstance(obj,dict):
         raise ValueError("object must be dictionary")
         
-    if len( obj.keys() ) != 1:
+    if len(obj) != 1:
         raise ValueError(
             "Wrong number of keys in the dictionary [%s]" % (obj.keys(),))
     
-    object_type = obj.keys()[0]
+    (object_type, value) = next(obj.iteritems())
     
-    if isinstance(obj[object_type],list) or isinstance(obj[object_type],tuple):
-        try:
-            (uriref,ava) = obj[object_type]
-            if ava == None:
+    if isinstance(value, (list, tuple)):
+        if len(value) == 2:
+            (uriref,ava) = value
+            if ava is None:
                 ava = {}
-        except ValueError:
-            uriref = obj[object_type][0]
+        else:
+            uriref = value[0]
             ava = {}
-    elif isinstance(obj[object_type],basestring):
-        uriref = obj[object_type]
+    elif isinstance(value,basestring):
+        uriref = value
         ava = {}
     else:
         raise ValueError("Wrong value format")
@@ -102,54 +133,95 @@ def unfurl(obj):
 def dict_join(dic0,dic1):
     for key,values in dic1.items():
         if key in dic0:
-            for val in values:
-                if val in dic0[key]:
-                    pass
-                else:
-                    dic0[key].append(val)
+            existing = dic0[key]
+            try:
+                seen = set(existing)
+                for val in values:
+                    if val not in seen:
+                        seen.add(val)
+                        existing.append(val)
+            except TypeError:
+                # unhashable values, fall back to scanning the list
+                for val in values:
+                    if val not in existing:
+                        existing.append(val)
         else:
             dic0[key] = values
     return dic0
     
+def _freeze(obj):
+    """ A hashable equivalent of a structure of dictionaries, lists and
+    tuples. Raises TypeError if something in it can't be hashed.
+    Every value is paired with its type, values that are equal but of 
+    different types, like URIRef(u"x") and u"x" or 1 and True, end up in 
+    different SPARQL and must not share a key."""
+    if isinstance(obj, dict):
+        return (dict, tuple(sorted([(_freeze(k), _freeze(v)) \
+                                        for k, v in obj.items()])))
+    elif isinstance(obj, (list, tuple)):
+        return (type(obj), tuple([_freeze(v) for v in obj]))
+    hash(obj)
+    return (type(obj), obj)
+
+def _add_once(items, seen, item):
+    if item not in seen:
+        seen.add(item)
+        items.append(item)
+
 def set_lang(val):
-    if isinstance(val,basestring) and ";lang-" in val:
-        str,lang = val.split(";lang-")
-        return Literal(str,lang=lang.lower())
+    if not isinstance(val,basestring):
+        return val
+    (text, sep, lang) = val.rpartition(";lang-")
+    if sep:
+        return Literal(text,lang=lang.lower())
     else:
         return val
 
 class NextHop(object):
     """ Base class for protocol specific implementation of the nexthop """
+    __slots__ = ("path",)
+    
     def __init__(self, path):
         self.path = path
         
     def write(self, data):
         pass 
         
+    def close(self):
+        pass
+        
 class _Uds(NextHop):
-    """ For writing to a Unix Domain Socket """
+    """ For writing to a Unix Domain Socket, the listener takes one message
+    per connection so every write is done on a connection of its own """
+    __slots__ = ()
+    
     def __init__(self, path):
-        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         NextHop.__init__(self, path[4:])
 
     def write(self, data):
-        self.server.connect(self.path)
-        self.server.send(data)
-        data = self.server.recv(1024)
-        data.strip("\r\n")
-        self.server.close()
-        if data == "OK":
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.connect(self.path)
+            server.sendall(data)
+            reply = server.recv(1024)
+        finally:
+            server.close()
+        if reply.strip("\r\n") == "OK":
             return True
         else:
             return False
 
 class _Http(NextHop):
     """ For writing to a HTTP server using PUT """
-    def __init__(self, path, key_file=None, cert_file=None):
+    __slots__ = ("server",)
+    
+    def __init__(self, path, key_file=None, cert_file=None, server=None):
         NextHop.__init__(self, path)
-        self.server = httplib2.Http()
-        if key_file:
-            self.server.add_certificate(key_file, cert_file, "")
+        if server is None:
+            server = httplib2.Http()
+            if key_file:
+                server.add_certificate(key_file, cert_file, "")
+        self.server = server
         
     def write(self, data):
         (response, content) = self.server.request(self.path, "PUT", data)
@@ -159,20 +231,51 @@ class _Http(NextHop):
             return False
 
 class _File(NextHop):
-    """ For writing to a file """
+    """ For writing to a file, the file is kept open between writes """
+    __slots__ = ("fil",)
+    
     def __init__(self, path):
         # path starts with 'file:///'
         NextHop.__init__(self, path[8:])
+        self.fil = None
         
     def write(self, data):
-        fil = open(self.path, "a+")
-        fil.write(data)
-        fil.write("\n")
-        fil.flush()
-        fil.close()
+        if not self.fil:
+            self.fil = open(self.path, "a+")
+        self.fil.write(data)
+        self.fil.write("\n")
+        self.fil.flush()
         return True
+
+    def close(self):
+        if self.fil:
+            self.fil.close()
+            self.fil = None
         
 
+def _check_urirefs(match, insert, replace):
+    """ Verifies the urirefs of the parts of a MIR operation, only match is
+    supposed to carry one. Nothing is changed. """
+    m_about = match.about
+    i_about = insert.about
+    r_about = replace.about
+    if not m_about:
+        raise MissingUriRefError("Match clause without uriref not allowed")
+    if (i_about and i_about != m_about) or \
+            (r_about and r_about != m_about):
+        raise MismatchedUriRefError("Mismatched urirefs not allowed")
+    if i_about and insert.type != match.type:
+        raise TypeMismatchError("Types on match and insert differ")
+
+def _clear_urirefs(insert, replace):
+    """ Removes the urirefs from the insert and replace parts of a MIR
+    operation that has passed _check_urirefs """
+    if insert.about:
+        insert.about = None
+    if replace.about:
+        replace.about = None
+
+
 class OM2(object):
     """An implementation of a om2 api, something that to an application
         provides something that might look like a database but which in fact
@@ -192,27 +295,46 @@ class OM2(object):
     :param debug: To turn on debugging
     :param verbose: Make some more verbose logging
     :param log: Logger to use
+    :param rdf_format: The rdflib serialization used for messages sent to
+        the nexthop, "pretty-xml" is used instead when debugging
+    :param cache_ttl: If set, the number of seconds NeoRepo lookups and 
+        SPARQL results are reused for. Everything cached is dropped 
+        when a message is applied.
+    :param return_message: If False and there is no nexthop, the 
+        message methods neither build nor return a message, they return 
+        None. The urirefs given to replace and insert_replace(_many) are 
+        still checked and insert still resolves the object type, but no
+        argument is changed. Ignored when debugging.
+
+    One httplib2.Http instance is shared by the NeoRepo lookups and an
+    HTTP(S) nexthop so that open connections are reused across calls.
     """
     
     def __init__(self, neorepo=None, nexthop=None, dnssrv=None, ontology=[],
         ontpath=[], sender="someone@example.com", receiver=[], 
-        key_file=None, cert_file=None, debug=0, verbose=False, log=None):
+        key_file=None, cert_file=None, debug=0, verbose=False, log=None,
+        rdf_format="xml", cache_ttl=0, return_message=True):
+        self._key_file = key_file
+        self._cert_file = cert_file
+        http = None
         if neorepo:
             if not neorepo.endswith("/"):
                 neorepo += "/"
-            self.neorepo = httplib2.Http()
-            self.sparql = sparql.Sparql(self.neorepo, neorepo+"sparql/",log)
+            self.neorepo = http = self._new_http()
+            self._sparql_url = neorepo+"sparql/"
+            self._sparql_log = log
+            self.sparql = sparql.Sparql(self.neorepo, self._sparql_url, log)
             self.lookup_path = neorepo+"lookup/"
-            if key_file:
-                self.neorepo.add_certificate(key_file, cert_file, "")
 
         if nexthop:
             if nexthop.startswith("http"):
-                self.nexthop = _Http(nexthop, key_file, cert_file)
+                self.nexthop = _Http(nexthop, key_file, cert_file, http)
             elif nexthop.startswith("uds:"):
                 self.nexthop = _Uds(nexthop)
             elif nexthop.startswith("file:///"):
                 self.nexthop = _File(nexthop)
+            else:
+                raise ValueError("Unknown nexthop scheme: %s" % nexthop)
         else:
             self.nexthop = None
             
@@ -226,84 +348,152 @@ class OM2(object):
         self.receiver = receiver
         self.debug = debug
         self.verbose = verbose
+        self.rdf_format = rdf_format
+        self.cache_ttl = cache_ttl
+        self.return_message = return_message
+        self._responses = {}
         self._name = "om2api"
         if not log:
             self.log = [StdOutLogger({}, name="om2api")]
         else:
             self.log = log
 
+    def _cached(self, key):
+        try:
+            (when, value) = self._responses[key]
+        except KeyError:
+            return None
+        if time.time() - when < self.cache_ttl:
+            return value
+        return None
+
+    def _cache(self, key, value):
+        if len(self._responses) >= RESPONSE_CACHE_SIZE:
+            self._responses.clear()
+        self._responses[key] = (time.time(), value)
+
+    def invalidate(self):
+        """ Forget all cached NeoRepo lookups and SPARQL results """
+        self._responses.clear()
+
+    def _query(self, client, query, amap):
+        # The rows end up with the caller, who may change them, so what is
+        # kept in the cache is never handed out, only copies of it
+        if self.cache_ttl:
+            result = self._cached(("sparql", query))
+            if result is not None:
+                return copy.deepcopy(result)
+        result = client.query(query, amap, self.debug)
+        if self.cache_ttl:
+            self._cache(("sparql", query), copy.deepcopy(result))
+        return result
+
+    def close(self):
+        """ Release what is held open towards the nexthop """
+        if self.nexthop:
+            self.nexthop.close()
+
+    def _new_http(self):
+        http = httplib2.Http()
+        if self._key_file:
+            http.add_certificate(self._key_file, self._cert_file, "")
+        return http
+
     def _parser(self, ontologies=[], path=["."]):
         self._onts = twist.do_import(ontologies, path)
+        # The ontologies don't change once imported so name lookups,
+        # including the ones that fail, can be remembered. The indexes map
+        # a short name to (ontology, full name) or None and are filled as
+        # names are asked for.
+        self._prop_index = {}
+        self._object_index = {}
+        self._ns_prop_cache = {}
+        self._query_cache = {}
+        self._range_cache = {}
+        self._fullname_cache = {}
         return parse.RdfParse(self._onts)
         
     def absolute_class_type(self, shortname):
-        for ontology in self._onts:
-            try:
-                objinst = ontology.ObjectFactory(shortname)
-                return str(objinst.type)
-            except KeyError:
-                pass
+        res = self._ontology(shortname)
+        if res:
+            return res[1]
         return None
 
-    def absolute_property(self, shortname):
+    def _property(self, shortname):
+        try:
+            return self._prop_index[shortname]
+        except KeyError:
+            pass
+        res = None
         for ontology in self._onts:
             try:
                 prop = ontology.PropertyFactory(shortname)
-                return str(prop.type)
+                res = (ontology, str(prop.type))
+                break
             except KeyError:
                 pass
+        self._prop_index[shortname] = res
+        return res
+
+    def absolute_property(self, shortname):
+        res = self._property(shortname)
+        if res:
+            return res[1]
         return None
         
     def absolute_property_by_object(self, shortname, typ=None):
         if not typ:
             return self.absolute_property(shortname)
-        for ontology in self._onts:
-            if self.verbose:
-                log_info(self, "INSTANCE TYPE: %s" % typ)
-            try:
-                if self.verbose:
-                    log_info(self, "%s" % ontology)
-                obj = ontology.ObjectFactory(typ)
-                if self.verbose:
-                    log_info(self, "Found objecttype: %s" % obj)
-                try:
-                    return obj.class_property[shortname]
-                except KeyError:
-                    pass
-                return None
-            except KeyError:
-                #if self.verbose:
-                #    log_error(self, error_description(excep=e))
-                pass
+        if self.verbose:
+            log_info(self, "INSTANCE TYPE: %s" % typ)
+        obj = self._class(typ)
+        if obj is None:
+            return None
+        if self.verbose:
+            log_info(self, "Found objecttype: %s" % obj)
+        if shortname in obj.class_property:
+            return obj.class_property[shortname]
         return None
 
     def absolute_property_in_namespace(self, shortname="", namespace=None):
         if not namespace:
             return self.absolute_property(shortname)
+        try:
+            return self._ns_prop_cache[(namespace, shortname)]
+        except KeyError:
+            pass
         for ontology in self._onts:
             if str(ontology.NS) == namespace:
                 prop = ontology.PropertyFactory(shortname)
-                return str(prop.type)
+                res = self._ns_prop_cache[(namespace, shortname)] = \
+                        str(prop.type)
+                return res
         raise KeyError("Unkown property: %s" % shortname)
                 
     def _class(self,classname):
-        classname = str(classname)
-        for ont in self._onts:
-            try:
-                return ont.ObjectFactory(classname)
-            except KeyError:
-                pass
+        # ObjectFactory hands out a new instance each time, only the 
+        # ontology it comes from is remembered
+        res = self._ontology(classname)
+        if res:
+            return res[0].ObjectFactory(str(classname))
         return None
     
     def _ontology(self, classname):
         classname = str(classname)
+        try:
+            return self._object_index[classname]
+        except KeyError:
+            pass
+        res = None
         for ont in self._onts:
             try:
                 inst = ont.ObjectFactory(classname)
-                return (ont, str(inst.type))
+                res = (ont, str(inst.type))
+                break
             except KeyError:
                 pass
-        return None
+        self._object_index[classname] = res
+        return res
         
     def absolute(self, object_type, *arg):
         """
@@ -335,7 +525,8 @@ class OM2(object):
                         "Could not find the type '%s' in my ontologies" % \
                             object_type)
                 return None
-            res = [fullname_from_ontology(ontology, a) for a in arg]
+            res = [fullname_from_ontology(ontology, a, self._fullname_cache) \
+                        for a in arg]
             return (atype, res)
         else:
             res = []
@@ -345,9 +536,8 @@ class OM2(object):
                 elif isinstance(prop,list):
                     res.extend([self.absolute_property(prp) for prp in prop])
                 elif isinstance(prop,dict):
-                    res.append(dict([
-                        (self.absolute_property(prp),v) \
-                        for prp,v in prop.items()]))
+                    res.append({self.absolute_property(prp): v \
+                        for prp,v in prop.items()})
             return res
 
     def _absolute_list(self, properties, object_type=None):
@@ -358,18 +548,18 @@ class OM2(object):
         :param object_type: The type of object that has these properties
         :return: Tuple with object type and property/value dictionary
         """
-        for ontology in self._onts:
-            try:
-                obj = ontology.ObjectFactory(object_type)
-                obj_type = str(obj.type)
-                proparr = {}
-                for prop, varr in properties.items():
-                    prop_type = str(ontology.PropertyFactory(prop).type)
-                    proparr[prop_type] = varr
-                return (obj_type, proparr)
-            except KeyError:
-                pass
-        return None
+        res = self._ontology(object_type)
+        if not res:
+            return None
+        (ontology, obj_type) = res
+        proparr = {}
+        try:
+            for prop, varr in properties.items():
+                prop_type = str(ontology.PropertyFactory(prop).type)
+                proparr[prop_type] = varr
+        except KeyError:
+            return None
+        return (obj_type, proparr)
 
     def _full(self, inst, key):
         if inst.allowed_property(key):
@@ -388,22 +578,25 @@ class OM2(object):
         if self.debug:
             log_debug(self, "Select:%s Optional:%s" % (select, optional))
         
-        selset = set([])
+        # lists rather than sets to keep the query the same from run to run
+        selset = []
+        selseen = set()
         for key in select:
             fnkey = self.absolute_property(key)
             if fnkey:
-                if fnkey not in filt.keys():
+                if fnkey not in filt:
                     filt[fnkey] = None
-                selset.add(fnkey)
+                _add_once(selset, selseen, fnkey)
             else:
                 log_info(self, "Property '%s' not known" % key)
 
-        optset = set([])            
+        optset = []
+        optseen = set()
         for key in optional:
             fnkey = self.absolute_property(key)
             if fnkey:
-                optset.add(fnkey)
-                selset.add(fnkey)
+                _add_once(optset, optseen, fnkey)
+                _add_once(selset, selseen, fnkey)
             else:
                 log_info(self, "Property '%s' not known" % key)
                         
@@ -418,9 +611,8 @@ class OM2(object):
             log_debug(self, "regex: %s" %  regexp_verified)
             log_debug(self, "select: %s" %  selset)
             log_debug(self, "optional: %s" %  optset)
-        return sparql.query_from_dictionary(crit=filt, 
-                select=list(selset), optd=list(optset), 
-                regex=regexp_verified, about=about)
+        return self._query_from_dictionary(None, filt, selset, optset,
+                regexp_verified, about)
 
     def _make_sparql(self, object_type, filt={}, select=[], optional=[], 
                         about=True, regex=[]):
@@ -432,23 +624,26 @@ class OM2(object):
             log_error(self, "Unknown object: %s" % (object_type))
             return None
         
-        selset = set([])
+        # lists rather than sets to keep the query the same from run to run
+        selset = []
+        selseen = set()
         for key in select:
             fnkey = self._full(inst,key)
             if fnkey:
-                if fnkey not in filt.keys():
+                if fnkey not in filt:
                     filt[fnkey] = None
-                selset.add(fnkey)
+                _add_once(selset, selseen, fnkey)
             else:
                 log_info(self, "Property '%s' not found in '%s'" % \
                         (key, str(inst.type)))
 
-        optset = set([])            
+        optset = []
+        optseen = set()
         for key in optional:
             fnkey = self._full(inst,key)
             if fnkey:
-                optset.add(fnkey)
-                selset.add(fnkey)
+                _add_once(optset, optseen, fnkey)
+                _add_once(selset, selseen, fnkey)
             else:
                 log_info(self, "Property '%s' not found in '%s'" % \
                         (key, str(inst.type)))
@@ -464,18 +659,50 @@ class OM2(object):
             log_debug(self, "regex: %s" %  regexp_verified)
             log_debug(self, "select: %s" %  selset)
             log_debug(self, "optional: %s" %  optset)
-        return sparql.query_from_dictionary(str(inst.type), filt, 
-                select=list(selset), optd=list(optset), 
-                regex=regexp_verified, about=about)
+        return self._query_from_dictionary(str(inst.type), filt, 
+                selset, optset, regexp_verified, about)
+
+    def _query_from_dictionary(self, object_type, filt, select, optd, regex,
+                                about):
+        """ sparql.query_from_dictionary with the resulting query and map
+        remembered, repeated searches of the same kind don't have to
+        build the query again. """
+        try:
+            key = _freeze((object_type, filt, select, optd, regex, about))
+        except TypeError:
+            key = None
+        if key is not None:
+            try:
+                (query, amap) = self._query_cache[key]
+                return (query, copy.copy(amap))
+            except KeyError:
+                pass
+        
+        if object_type:
+            (query, amap) = sparql.query_from_dictionary(object_type, filt, 
+                    select=select, optd=optd, regex=regex, about=about)
+        else:
+            (query, amap) = sparql.query_from_dictionary(crit=filt, 
+                    select=select, optd=optd, regex=regex, about=about)
+        
+        if key is not None:
+            if len(self._query_cache) >= QUERY_CACHE_SIZE:
+                self._query_cache.clear()
+            self._query_cache[key] = (query, copy.copy(amap))
+        return (query, amap)
 
     def _join(self, res):
         """
         :param res: 2-tuple containing (uriref,dic) or just uriref
+        :return: list of 2-tuples (uriref,dic), one per uriref with the 
+            property values of all its rows merged. Rows without a uriref
+            can't be merged, they come first with one tuple each.
         """
-        clean_list = {}
+        blank = []
+        merged = {}
+        order = []
         
         for item in res:
-            #log_info(self, "ITEM: %s" % (item,))
             try:
                 (uriref, ava) = item
             except ValueError:
@@ -483,31 +710,33 @@ class OM2(object):
                 ava = {}
                 
             if not uriref: 
+                blank.append(("", ava))
+                continue
+            try:
+                (props, seen) = merged[uriref]
+            except KeyError:
+                props = {}
+                seen = {}
+                merged[uriref] = (props, seen)
+                order.append(uriref)
+            for key, values in ava.items():
                 try:
-                    clean_list[""].append(ava)
+                    have = props[key]
+                    known = seen[key]
                 except KeyError:
-                    clean_list[""] = [ava]
-            if uriref in clean_list:
-                #log_info(self, "TWO items with the same uriref: %s" % uriref)
-                clean_list[uriref] = dict_join(clean_list[uriref],ava)
-                #log_info(self, ">> combines to: %s" % (clean_list[uriref]),)
-            else:
-                clean_list[uriref] = ava
-                
-        result = []
-        try:
-            for val in clean_list[""]:
-                result.append(("",val))
-        except KeyError:
-            pass
-        
-        for key, item in clean_list.items():
-            if key == "":
-                continue
-            else:
-                result.append((key,item))
-                
-        return result
+                    have = props[key] = []
+                    known = seen[key] = set()
+                for val in values:
+                    try:
+                        if val in known:
+                            continue
+                        known.add(val)
+                    except TypeError: # not hashable
+                        if val in have:
+                            continue
+                    have.append(val)
+                    
+        return blank + [(uriref, merged[uriref][0]) for uriref in order]
 
     def search( self, object_type=None, filt={}, select=[], 
                 sparql_query="", amap={}, optional=[], regex=[]):
@@ -531,6 +760,60 @@ class OM2(object):
             list of 2-tuples containing URIRef and property-values assertions
             as a dictionary. 
         """            
+        built = self._search_query(object_type, filt, select, sparql_query,
+                                    amap, optional, regex)
+        if built is None:
+            return None
+        (query, amap) = built
+        # result is a list of 2-tuples consisting of the object identifier
+        #  and the object
+        result = self._query(self.sparql, query, amap)
+        return self._search_result(result, select)
+
+    def search_many(self, specs, workers=8):
+        """
+        Do a number of searches in the neorepo. The queries are built
+        up front and then sent in parallel so the round trips overlap.
+        
+        :param specs: A list of dictionaries, each one holding the keyword
+            arguments of one :meth:`search` call.
+        :param workers: The maximum number of queries in progress at once
+        :return: A list with the search results, in the same order as specs.
+            None for a search whose query couldn't be built.
+        """
+        if workers < 1:
+            raise ValueError("workers must be at least 1, not %s" % workers)
+        queries = [self._search_query(spec.get("object_type"),
+                        spec.get("filt", {}), spec.get("select", []),
+                        spec.get("sparql_query", ""), spec.get("amap", {}),
+                        spec.get("optional", []), spec.get("regex", [])) \
+                    for spec in specs]
+        todo = [q for q in queries if q is not None]
+        if not todo:
+            return [None] * len(queries)
+        # the Sparql client wraps a httplib2.Http which is not thread safe,
+        # each worker gets a client of its own
+        local = threading.local()
+        def fetch(built):
+            (query, amap) = built
+            try:
+                client = local.client
+            except AttributeError:
+                client = local.client = sparql.Sparql(self._new_http(),
+                                            self._sparql_url, self._sparql_log)
+            return self._query(client, query, amap)
+        
+        pool = ThreadPool(min(workers, len(todo)))
+        try:
+            results = iter(pool.map(fetch, todo))
+        finally:
+            pool.close()
+        return [self._search_result(results.next(), spec.get("select", [])) \
+                    if query is not None else None \
+                    for (spec, query) in zip(specs, queries)]
+
+    def _search_query(self, object_type, filt, select, sparql_query, amap,
+                        optional, regex):
         if sparql_query:
             query = sparql_query            
         else:
@@ -549,27 +832,34 @@ class OM2(object):
         if self.debug or self.verbose:
             log_debug(self, "QUERY: %s" % safe_str(query))
             log_debug(self, "Amap: %s" % amap)
-        # result is a list of 2-tuples consisting of the object identifier
-        #  and the object
-        result = self.sparql.query(query, amap, self.debug)
+        return (query, amap)
+
+    def _search_result(self, result, select):
         if self.debug:
             log_debug(self, "Result: %s" % result)
         if select == ["about"]:
-            return list(set([uri for (uri, obj) in result]))
+            return list({uri for (uri, obj) in result})
         else:
             return self._join(result)
         
-    def read( self, uri):
-        """
-        Read an object from the neorepo.
-        
-        :param uri: The NeoRepo URI of the object that is wanted
-        :return: The Object as a rdfmarshal Base class instance.
-        """            
+    def _lookup(self, http, uri):
+        if isinstance(uri, unicode):
+            uri = uri.encode("utf-8")
         lookup_uri = self.lookup_path+urllib.quote_plus(uri)
         if self.verbose:
             log_info(self, "lookup URL: %s" % lookup_uri)
-        (response, content) = self.neorepo.request(lookup_uri)
+        if self.cache_ttl:
+            # the raw answer is kept, and parsed anew each time, so that
+            # callers never share an object
+            reply = self._cached(("lookup", lookup_uri))
+            if reply is not None:
+                return reply
+        reply = http.request(lookup_uri)
+        if self.cache_ttl and reply[0].status == 200:
+            self._cache(("lookup", lookup_uri), reply)
+        return reply
+
+    def _lookup_result(self, response, content):
         if self.debug:
             log_info(self, "Response: %s" % response)
             log_info(self, "Content: %s" % content)
@@ -584,6 +874,49 @@ class OM2(object):
         else:
             raise Exception("status:%s" % response.status)
 
+    def read( self, uri):
+        """
+        Read an object from the neorepo.
+        
+        :param uri: The NeoRepo URI of the object that is wanted
+        :return: The Object as a rdfmarshal Base class instance.
+        """            
+        (response, content) = self._lookup(self.neorepo, uri)
+        return self._lookup_result(response, content)
+
+    def read_many(self, uris, workers=8):
+        """
+        Read a number of objects from the neorepo. The lookups are done 
+        in parallel so the round trips overlap, the responses are parsed
+        one at a time in the calling thread.
+        
+        :param uris: The NeoRepo URIs of the objects that are wanted
+        :param workers: The maximum number of lookups in progress at once
+        :return: A list with the Objects, in the same order as uris. As for
+            read, None for an object the NeoRepo couldn't find.
+        """
+        if workers < 1:
+            raise ValueError("workers must be at least 1, not %s" % workers)
+        uris = list(uris)
+        if not uris:
+            return []
+        # httplib2.Http is not thread safe, each worker gets one of its own
+        local = threading.local()
+        def fetch(uri):
+            try:
+                http = local.http
+            except AttributeError:
+                http = local.http = self._new_http()
+            return self._lookup(http, uri)
+        
+        pool = ThreadPool(min(workers, len(uris)))
+        try:
+            replies = pool.map(fetch, uris)
+        finally:
+            pool.close()
+        return [self._lookup_result(response, content) \
+                    for (response, content) in replies]
+
     def apply( self, rdf, block_until_handled=True ):
         """
         Applies the operations in the RDF XML graph to the 'cloud',
@@ -596,18 +929,41 @@ class OM2(object):
             applied the operation. 
         :return: True/False
         """
-        rdf_xml = rdf.graph("pretty-xml")
         if self.debug:
+            rdf_xml = rdf.graph("pretty-xml")
             log_info(self,"RDF_XML: %s" % rdf_xml)
-        if self.nexthop:
+        else:
+            rdf_xml = rdf.graph(self.rdf_format)
+        nexthop = self.nexthop
+        if nexthop:
+            if self.cache_ttl:
+                self.invalidate()
             try:
-                return self.nexthop.write(rdf_xml)
+                return nexthop.write(rdf_xml)
             except socket.error:
                 return False
         else:
             return rdf_xml
 
-    def add(self, objekt, args={}):
+    def apply_many(self, rdfs, block_until_handled=True):
+        """
+        Applies a sequence of RDF graphs, one after the other, see apply.
+        
+        :param rdfs: An iterable of rdfmashal.base.Base instances
+        :return: A list with one result per graph, as apply would have
+            returned them.
+        """
+        apply = self.apply
+        return [apply(rdf, block_until_handled) for rdf in rdfs]
+
+    def _sink(self, nexthop, debug):
+        """ Whether a message would be built only to be thrown away, there 
+        is no nexthop to send it to, it is not to be returned and nobody 
+        is debugging. Callers pass in their own reads of self.nexthop and 
+        self.debug. """
+        return nexthop is None and not (debug or self.return_message)
+
+    def add(self, objekt, args=None):
         """
         Sends an add operation to the 'cloud' represented by 'nexthop'
         
@@ -621,16 +977,17 @@ class OM2(object):
             done so by the use of this argument.
         :return: True/False
         """
+        if self._sink(self.nexthop, self.debug):
+            return None
         msg = miroop.new_add_message(objekt, self.sender, self.receiver, 
                     args=args)
         if self.verbose:
             log_info(self, "Add message: %s" % msg.dumps())
-        if self.nexthop:
-            return self.apply(msg)
-        else:
+        if self.nexthop is None:
             return msg
+        return self.apply(msg)
 
-    def delete(self, uriref, args={}):
+    def delete(self, uriref, args=None):
         """
         Sends a delete operation to the node 'nexthop'
         
@@ -644,21 +1001,32 @@ class OM2(object):
             done so by the use of this argument.
         :return: True/False
         """
+        if self._sink(self.nexthop, self.debug):
+            return None
         msg = miroop.new_delete_message(uriref, self.sender, self.receiver, 
                     args=args)
-        if self.nexthop:
-            return self.apply(msg) 
-        else:
+        if self.nexthop is None:
             return msg
+        return self.apply(msg)
+
+    def _is_reference(self, obj, key):
+        """ Whether the values of the property key of obj are references
+        to other objects, remembered per object type and property """
+        try:
+            return self._range_cache[(obj.type, key)]
+        except KeyError:
+            pass
+        res = False
+        for ran in obj.property(key).range():
+            if isinstance(ran, type) and base.Base in ran.__mro__:
+                res = True
+                break
+        self._range_cache[(obj.type, key)] = res
+        return res
 
     def _do_string(self, val, obj, key):
-        prop = obj.property(key)
-        for ran in prop.range():
-            if isinstance(ran, type):
-                #print "TYPE type",ran
-                if base.Base in ran.__mro__:
-                    return URIRef(val)
-        
+        if self._is_reference(obj, key):
+            return URIRef(val)
         return set_lang(val)
 
     def _do_value(self,val, obj, key):
@@ -668,34 +1036,56 @@ class OM2(object):
         else:
             return self._do_string(val, obj, key)
             
+    def _do_list(self, values, obj, key):
+        is_ref = self._is_reference(obj, key)
+        res = []
+        for val in values:
+            if isinstance(val, dict):
+                res.append(self._do_value(val, obj, key))
+            elif is_ref:
+                res.append(URIRef(val))
+            else:
+                res.append(set_lang(val))
+        return res
+
+    def _do_none(self, values, obj, key):
+        return None
+
+    # How make_object converts a value given its exact type, subclasses 
+    # like URIRef and Literal are sorted out by isinstance
+    _value_handlers = {str: _do_string, unicode: _do_string, dict: _do_value,
+                        list: _do_list, type(None): _do_none}
+
     def make_object(self, objekt_type, uriref=None, ava={}):
-        for ont in self._onts:
-            try:
-                obj = ont.ObjectFactory(objekt_type)
-                if uriref != None:
-                    obj.about = uriref
-                if ava:
-                    for key,values in ava.items():
-                        if values == None:
-                            new = None
-                        elif isinstance(values, basestring):
-                            new = self._do_string(values, obj, key)
-                        elif isinstance(values,dict):
-                            new = self._do_value(values, obj, key)
-                        elif isinstance(values,list):
-                            prop = obj.property(key)
-                            new = [self._do_value(val, obj, key) for val in values]
-                        else:
-                            new = values
-                        #print new,type(new)
-                        obj[key] = new
-                return obj
-            except KeyError:
-                pass
-        raise Exception("Couldn't create object of type: '%s' (%s)" % \
-            (objekt_type, self._onts))
+        res = self._ontology(objekt_type)
+        if not res:
+            raise Exception("Couldn't create object of type: '%s' (%s)" % \
+                (objekt_type, self._onts))
+        try:
+            obj = res[0].ObjectFactory(str(objekt_type))
+            if uriref != None:
+                obj.about = uriref
+            if ava:
+                handlers = self._value_handlers
+                for key,values in ava.items():
+                    handler = handlers.get(type(values))
+                    if handler:
+                        new = handler(self, values, obj, key)
+                    elif isinstance(values, basestring):
+                        new = self._do_string(values, obj, key)
+                    elif isinstance(values,dict):
+                        new = self._do_value(values, obj, key)
+                    elif isinstance(values,list):
+                        new = self._do_list(values, obj, key)
+                    else:
+                        new = values
+                    obj[key] = new
+            return obj
+        except KeyError:
+            raise Exception("Couldn't create object of type: '%s' (%s)" % \
+                (objekt_type, self._onts))
         
-    def insert( self, obj, create=False, args={}):
+    def insert( self, obj, create=False, args=None):
         """
         Sends a insert operation to 'nexthop' that will
         modify the the object in questions to include the given information
@@ -713,6 +1103,8 @@ class OM2(object):
         """
         
         match = self.make_object(str(obj.type),obj.about)
+        if self._sink(self.nexthop, self.debug):
+            return None
         if create:
             obj.about = ""
             msg = miroop.new_insert_or_add_message(match, obj, obj, 
@@ -721,13 +1113,12 @@ class OM2(object):
             msg = miroop.new_insert_message(obj, self.sender, self.receiver, 
                                             match=match, args=args)
         if self.debug:
-            log_debug(self,"insert: %s" % msg.struct())
-        if self.nexthop:
-            return self.apply(msg)
-        else:
+            log_debug(self,"insert: %s" % miroop.summary(msg))
+        if self.nexthop is None:
             return msg
+        return self.apply(msg)
 
-    def remove(self, object, args={}):
+    def remove(self, object, args=None):
         """Removes a part of an object. A remove operation is always a M 
         operation in MIRO parlance.
         
@@ -742,17 +1133,18 @@ class OM2(object):
         :return: True/False
         """
 
+        if self._sink(self.nexthop, self.debug):
+            return None
         body = miroop.new_body({"M":object})
         msg = miroop.new_message(body, self.sender, self.receiver, args=args)
 
         if self.debug:
-            log_debug(self,"Remove: %s" % msg.struct())
-        if self.nexthop:
-            return self.apply(msg)
-        else:
+            log_debug(self,"Remove: %s" % miroop.summary(msg))
+        if self.nexthop is None:
             return msg
+        return self.apply(msg)
             
-    def replace(self, match, replace, args={}):
+    def replace(self, match, replace, args=None):
         """An replace information operation is always a MR operation in MIRO 
         parlance.
         
@@ -770,27 +1162,32 @@ class OM2(object):
         # make sure the don't both have the same uriref's
         # match has to have a uriref
         
-        if not match.about:
-            raise Exception("Match clause without uriref not allowed")
+        m_about = match.about
+        r_about = replace.about
+        if not m_about:
+            raise MissingUriRefError("Match clause without uriref not allowed")
+        if r_about and r_about != m_about:
+            raise MismatchedUriRefError("Mismatched urirefs not allowed")
         
-        if replace.about:
-            if replace.about != match.about:
-                raise Exception("Mismatched urirefs not allowed")
+        nexthop = self.nexthop
+        debug = self.debug
+        if self._sink(nexthop, debug):
+            return None
+        if r_about:
             replace.about = None
         
-        body = miroop.new_body({"M":match, "R":replace})
-        msg = miroop.new_message(body, self.sender, self.receiver, args=args)
-        if self.debug:
-            log_debug(self,"Replace: %s" % msg.struct())
-        if self.nexthop:
-            ret = self.apply(msg)
-            if self.debug:
-                log_debug(self,"Replace returned: %s" % ret)
-            return ret
-        else:
+        msg = miroop.new_replace_message(match, replace, self.sender,
+                    self.receiver, args=args)
+        if debug:
+            log_debug(self,"Replace: %s" % miroop.summary(msg))
+        if nexthop is None:
             return msg
+        ret = self.apply(msg)
+        if debug:
+            log_debug(self,"Replace returned: %s" % ret)
+        return ret
 
-    def insert_replace(self, match, insert, replace, args={}):
+    def insert_replace(self, match, insert, replace, args=None):
         """An replace information operation is always a MR operation in MIRO 
         parlance.
         
@@ -806,29 +1203,134 @@ class OM2(object):
             done so by the use of this argument.
         :return: True/False
         """
-        # make sure the don't both have the same uriref's
-        # match has to have a uriref
+        _check_urirefs(match, insert, replace)
+        nexthop = self.nexthop
+        debug = self.debug
+        if self._sink(nexthop, debug):
+            return None
+        _clear_urirefs(insert, replace)
+        msg = miroop.new_insert_replace_message(match, insert, replace,
+                    self.sender, self.receiver, args=args)
+        if debug:
+            log_debug(self,"Insert replace: %s" % miroop.summary(msg))
+        if nexthop is None:
+            return msg
+        return self.apply(msg)
+
+    def insert_replace_many(self, triples, args_list=None):
+        """Does what insert_replace does for a whole sequence of MIR 
+        operations. All the messages share one createTime.
         
-        if not match.about:
-            raise Exception("Match clause without uriref not allowed")
-        
-        if insert.about:
-            if insert.about != match.about:
-                raise Exception("Mismatched urirefs not allowed")
-            insert.about = None
-            if insert.type != match.type:
-                raise Exception("Types on match and insert differ")
-        if replace.about:
-            if replace.about != match.about:
-                raise Exception("Mismatched urirefs not allowed")
-            replace.about = None
+        :param triples: An iterable of (match, insert, replace) tuples
+        :param args_list: None or a list with one args dictionary (or None)
+            per triple, see insert_replace.
+        :return: A list with one result per triple, as insert_replace 
+            would have returned them. None, like insert_replace, when there 
+            is no nexthop and return_message is off.
         
-        body = miroop.new_body({"M":match, "R":replace, "I":insert})
-        msg = miroop.new_message(body, self.sender, self.receiver, args=args)
+        Every triple is verified before any of them is changed, so if one 
+        is rejected none of the others have lost their urirefs.
+        """
+        triples = list(triples)
+        if args_list is None:
+            args_list = [None] * len(triples)
+        elif len(args_list) != len(triples):
+            raise ValueError("One args per triple expected")
+        for (match, insert, replace) in triples:
+            _check_urirefs(match, insert, replace)
+        if self._sink(self.nexthop, self.debug):
+            return None
+        for (match, insert, replace) in triples:
+            _clear_urirefs(insert, replace)
+        bodies = [miroop.new_insert_replace_body(match, insert, replace) \
+                    for (match, insert, replace) in triples]
+        msgs = miroop.new_messages_bulk(zip(bodies, args_list), self.sender, 
+                    self.receiver)
         if self.debug:
-            log_debug(self,"Insert replace: %s" % msg.struct())
-        if self.nexthop:
-            return self.apply(msg)
-        else:
-            return msg
+            for msg in msgs:
+                log_debug(self,"Insert replace: %s" % miroop.summary(msg))
+        if self.nexthop is None:
+            return msgs
+        return self.apply_many(msgs)
+
+
+__test__ = {"insert_replace_many": """
+>>> import pyom.ontology.prim_3 as prim
+>>> def person(about="", **props):
+...     p = prim.Person()
+...     p.about = about
+...     for key, val in props.items():
+...         p[key] = val
+...     return p
+>>> api = OM2()
+>>> triples = [(person("http://example.com/p#a"), person(givenName="Derek"),
+...             person(surName="Jeter")),
+...            (person("http://example.com/p#b"), 
+...             person("http://example.com/p#b", givenName="Mariano"),
+...             person("http://example.com/p#b", surName="Rivera"))]
+>>> msgs = api.insert_replace_many(triples)
+>>> [miroop.operation(msg["body"][0]) for msg in msgs]
+['MIR', 'MIR']
+>>> msgs[0]["createTime"] == msgs[1]["createTime"]
+True
+>>> [bool(part.about) for (match, insert, replace) in triples 
+...     for part in (insert, replace)]
+[False, False, False, False]
+""", "insert_replace_many verifies first": """
+>>> import pyom.ontology.prim_3 as prim
+>>> def person(about="", **props):
+...     p = prim.Person()
+...     p.about = about
+...     for key, val in props.items():
+...         p[key] = val
+...     return p
+>>> api = OM2()
+>>> good = person("http://example.com/p#a", givenName="Derek")
+>>> bad = person("http://example.com/p#c", givenName="Mariano")
+>>> api.insert_replace_many([(person("http://example.com/p#a"), good, 
+...                           person(surName="Jeter")),
+...                          (person("http://example.com/p#b"), bad,
+...                           person(surName="Rivera"))])
+Traceback (most recent call last):
+...
+MismatchedUriRefError: Mismatched urirefs not allowed
+>>> print good.about
+http://example.com/p#a
+""", "return_message": """
+>>> import pyom.ontology.prim_3 as prim
+>>> match = prim.Person()
+>>> match.about = "http://example.com/p#a"
+>>> insert = prim.Person()
+>>> insert.about = "http://example.com/p#a"
+>>> replace = prim.Person()
+>>> replace.about = ""
+>>> api = OM2(return_message=False)
+>>> print api.insert_replace(match, insert, replace)
+None
+>>> print insert.about
+http://example.com/p#a
+""", "apply_many": """
+>>> import os
+>>> import pyom.ontology.prim_3 as prim
+>>> p = prim.Person()
+>>> p.about = "http://example.com/p#a"
+>>> api = OM2(nexthop="file:///om2api_doctest.out", cache_ttl=60)
+>>> msgs = [miroop.new_delete_message(p, api.sender) for i in range(2)]
+>>> api.apply_many(msgs)
+[True, True]
+>>> api.close()
+>>> os.remove("om2api_doctest.out")
+""", "invalidate": """
+>>> api = OM2(cache_ttl=60)
+>>> api._cache(("lookup", "http://example.com/p#a"), "cached")
+>>> api._cached(("lookup", "http://example.com/p#a"))
+'cached'
+>>> api.invalidate()
+>>> print api._cached(("lookup", "http://example.com/p#a"))
+None
+"""}
+
+if __name__ == '__main__':
+    import doctest
 
+    doctest.testmod()
@@ -4,6 +4,8 @@
 """
 Functions that contain logic specific to the MIRO ontology
 """
+import itertools
+import os
 import time
 
 from pyom.ontology import om2_1
@@ -23,6 +25,35 @@ class NotAllowedConstruct(Exception):
 # -----------------------------------------------------------------------------
 # New message
 
+# createTime only has second resolution so the formatted string is reused
+# until the clock moves on. Two threads racing here would both store the
+# same string for the same second, so no lock is needed.
+_ts_cache = [0, ""]
+
+
+def _create_time():
+    now = int(time.time())
+    if now != _ts_cache[0]:
+        _ts_cache[1] = time.strftime("%FT%T", time.localtime(now))
+        _ts_cache[0] = now
+    return _ts_cache[1]
+
+_MISSING = object()
+
+# Message ids only have to be unique, so one uuid1() per process is used as a
+# prefix and a counter makes each id distinct. The pid is remembered so that
+# a forked child picks a prefix of its own.
+_mid_state = [None, None, None]
+
+
+def _new_mid():
+    pid = os.getpid()
+    if _mid_state[0] != pid:
+        _mid_state[1] = uuid1().hex + "-"
+        _mid_state[2] = itertools.count()
+        _mid_state[0] = pid
+    return _mid_state[1] + "%x" % next(_mid_state[2])
+
 
 def new_message(oper, sender, receiver=None, args=None):
     """
@@ -35,45 +66,112 @@ def new_message(oper, sender, receiver=None, args=None):
         a receiver specified
     :param args: Other properties that a message may have
     """
+    return _new_message(oper, sender, receiver, args, _create_time())
+
+
+def new_messages_bulk(entries, sender, receiver=None):
+    """
+    creates a list of message graphs that all share sender, receiver and
+    createTime
+
+    :param entries: An iterable of (oper, args) pairs, one per message, with
+        the same meaning as the corresponding arguments to new_message
+    :param sender: The sender of the messages
+    :param receiver: The receivers of the messages
+    """
+    create_time = _create_time()
+    return [_new_message(oper, sender, receiver, args, create_time)
+            for (oper, args) in entries]
+
+
+def _new_message(oper, sender, receiver, args, create_time):
     msg = om2_1.Message()
+    # Message is an rdfmarshal instance with a Python level __setitem__,
+    # calling it directly skips the subscript dispatch
+    set_prop = msg.__setitem__
     if oper:
-        msg["body"] = oper
-    msg["source"] = sender
+        set_prop("body", oper)
+    set_prop("source", sender)
     if receiver:
-        msg["receiver"] = receiver
-    msg["createTime"] = time.strftime("%FT%T")
-    try:
-        msg["mid"] = args["mid"]
-        del args["mid"]
-    except (KeyError, TypeError):
-        msg["mid"] = "%s" % (uuid1(), )
+        set_prop("receiver", receiver)
+    set_prop("createTime", create_time)
+    if args is None:
+        # by far the most common case
+        set_prop("mid", _new_mid())
+        return msg
+
+    mid = args.pop("mid", _MISSING)
+    set_prop("mid", _new_mid() if mid is _MISSING else mid)
 
     if args:
         for key, val in args.items():
-            if sender and key == "sender":  # don't overwrite
-                continue
-            if receiver and key == "receiver":
+            # don't overwrite what has already been set above
+            if key == "body" or (sender and key == "sender") or \
+                    (receiver and key == "receiver"):
                 continue
-            if key == "body":
-                continue
-
-            msg[key] = val
+            set_prop(key, val)
 
     return msg
 
+
+def summary(msg):
+    """
+    returns a one line description of a message graph, its mid, sender and
+    receiver. Unlike msg.struct() this does not walk the operations in the
+    body.
+
+    :param msg: A message as returned by new_message
+    """
+    if "receiver" in msg:
+        receiver = msg["receiver"][0]
+    else:
+        receiver = ""
+    return "%s %s->%s" % (msg["mid"][0], msg["source"][0], receiver)
+
 # The combinations of properties that are allowed
-ALLOWEDCONSTRUCTS = ["MIRO", "MIR", "MI", "MR", "O", "MIO", "MRO", "MO", "M"]
+ALLOWEDCONSTRUCTS = frozenset(["MIRO", "MIR", "MI", "MR", "O", "MIO", "MRO",
+                               "MO", "M"])
+
+# The parts of a MIRO operation in optype order, and the ones a missing
+# match may be derived from
+_PARTS = ("match", "insert", "replace", "otherwiseInsert")
+_MATCH_SOURCES = ("insert", "replace", "otherwiseInsert")
+
+# Every optype handed out by operation() is interned, so the predicates
+# can compare identity instead of equality.
+_OPT_M = intern("M")
+_OPT_O = intern("O")
+_OPT_MR = intern("MR")
+
+# One bit per part, used by new_body() to test for parts without searching
+# the optype string
+_M_BIT = 1
+_I_BIT = 2
+_R_BIT = 4
+_O_BIT = 8
+
+# ALLOWEDCONSTRUCTS expressed as part bits
+_ALLOWED_MASKS = frozenset([
+    0b1111,  # MIRO
+    0b0111,  # MIR
+    0b0011,  # MI
+    0b0101,  # MR
+    0b1000,  # O
+    0b1011,  # MIO
+    0b1101,  # MRO
+    0b1001,  # MO
+    0b0001,  # M
+])
 
 
 def _verify_about(oper, parts):
     for part in parts:
         if part in oper:
-            if isinstance(oper[part][0], basestring):
-                continue
-            try:
-                _ = oper[part][0].about
-            except AttributeError:
-                oper[part][0].about = ""
+            first = oper[part][0]
+            # a plain uriref string has no about and can't be given one
+            if getattr(first, "about", _MISSING) is _MISSING and \
+                    not isinstance(first, basestring):
+                first.about = ""
 
 
 def new_body(args):
@@ -83,48 +181,90 @@ def new_body(args):
         dictionary. The Keys comes from the set "M", "I", "R", "O".
     """
     oper = miro.MIRO()
-    optype = ""
+    flags = 0
+    # A part given as None still counts, "M": None means that the match
+    # should be derived from one of the other parts.
+    has_arg = args.__contains__
+
+    if has_arg("M"):
+        oper["match"] = args["M"]
+        flags |= _M_BIT
+    elif has_arg("match"):
+        oper["match"] = args["match"]
+        flags |= _M_BIT
+    if has_arg("I"):
+        oper["insert"] = args["I"]
+        flags |= _I_BIT
+    elif has_arg("insert"):
+        oper["insert"] = args["insert"]
+        flags |= _I_BIT
+    if has_arg("R"):
+        oper["replace"] = args["R"]
+        flags |= _R_BIT
+    elif has_arg("replace"):
+        oper["replace"] = args["replace"]
+        flags |= _R_BIT
+    if has_arg("O"):
+        oper["otherwiseInsert"] = args["O"]
+        flags |= _O_BIT
+    elif has_arg("otherwiseInsert"):
+        oper["otherwiseInsert"] = args["otherwiseInsert"]
+        flags |= _O_BIT
+
+    return _check_body(oper, flags)
+
+
+def _new_mr_body(match, replace, insert=_MISSING):
+    """Builds a *Match*+*Replace* operation, with *Insert* if given,
+    without going through the argument dictionary of new_body.
+    """
+    oper = miro.MIRO()
+    oper["match"] = match
+    if insert is _MISSING:
+        flags = _M_BIT | _R_BIT
+    else:
+        oper["insert"] = insert
+        flags = _M_BIT | _I_BIT | _R_BIT
+    oper["replace"] = replace
+    return _check_body(oper, flags)
 
-    for (short_name, long_name) in [("M", "match"), ("I", "insert"),
-                                    ("R", "replace"), ("O", "otherwiseInsert")]:
-        if short_name in args:
-            oper[long_name] = args[short_name]
-            optype += short_name
-        elif long_name in args:
-            oper[long_name] = args[long_name]
-            optype += short_name
 
-    if optype not in ALLOWEDCONSTRUCTS:
+def _check_body(oper, flags):
+    """Verifies the operation whose parts are marked in `flags` and
+    cleans up the urirefs of the parts.
+    """
+    if flags not in _ALLOWED_MASKS:
         raise NotAllowedConstruct("%s not an allowed MIRO construct" %
-                                  (optype, ))
-
-    _verify_about(oper, ["match", "insert", "replace", "otherwiseInsert"])
-    if "match" in oper:
-        if not oper["match"]:
-            match = None
-            for typ in ["insert", "replace", "otherwiseInsert"]:
-                if typ in oper:
-                    match = oper[typ][0].__class__()
-                    match.about = oper[typ][0].about
-                    oper[typ][0].about = ""
-                    break
-            try:
-                oper["match"] = match
-            except NameError:
-                raise MiroSpecException("Missing match specification")
-
-    if "O" in optype and "M" in optype:
-        if oper["otherwiseInsert"][0].about == oper["match"][0].about:
-            oper["otherwiseInsert"][0].about = ""
-
-    if "M" in optype:
-        if "R" in optype:
-            if oper["replace"][0].about and \
-                    oper["replace"][0] == oper["match"][0].about:
-                oper["replace"][0].about = ""
-        if "I" in optype:
-            if oper["insert"][0].about:
-                oper["insert"][0].about = ""
+                                  (operation(oper), ))
+
+    _verify_about(oper, _PARTS)
+    if "match" in oper and not oper["match"]:
+        match = None
+        for typ in _MATCH_SOURCES:
+            if typ in oper:
+                part = oper[typ][0]
+                match = part.__class__()
+                match.about = part.about
+                part.about = ""
+                break
+        if match is None:
+            raise MiroSpecException("Missing match specification")
+        oper["match"] = match
+
+    if flags & _M_BIT:
+        match = oper["match"][0]
+        if flags & _O_BIT:
+            add = oper["otherwiseInsert"][0]
+            if add.about == match.about:
+                add.about = ""
+        if flags & _R_BIT:
+            replace = oper["replace"][0]
+            if replace.about and replace == match.about:
+                replace.about = ""
+        if flags & _I_BIT:
+            insert = oper["insert"][0]
+            if insert.about:
+                insert.about = ""
 
     return oper
 
@@ -216,11 +356,31 @@ def new_replace_body(match, replace):
     - object: This object defines what can be changed.
     - new: This object defines to what.
     """
-    return new_body({"R": replace, "M": match})
+    return _new_mr_body(match, replace)
 
 
 def new_replace_message(match, replace, sender, receiver=None, args=None):
-    return new_message(new_replace_body(match, replace), sender, receiver, args)
+    return _new_message(_new_mr_body(match, replace), sender, receiver, args,
+                        _create_time())
+
+
+def new_insert_replace_body(match, insert, replace):
+    """
+    Creates a *Match*+*Insert*+*Replace* type of operation. The *Replace*
+    part changes what the *Match* pattern selects and the *Insert* part
+    is added to the same object.
+
+    - `match`: The part of the object that should be replaced
+    - `insert`: The object that is to be inserted
+    - `replace`: The object it should be replaced with
+    """
+    return _new_mr_body(match, replace, insert)
+
+
+def new_insert_replace_message(match, insert, replace, sender, receiver=None,
+                               args=None):
+    return _new_message(_new_mr_body(match, replace, insert), sender,
+                        receiver, args, _create_time())
 
 
 def new_replace_or_add_body(match, replace, add):
@@ -253,16 +413,16 @@ def operation(oper):
 
     - `op`: An operation
     """
-    res = ""
+    parts = []
     if "match" in oper:
-        res += "M"
+        parts.append("M")
     if "insert" in oper:
-        res += "I"
+        parts.append("I")
     if "replace" in oper:
-        res += "R"
+        parts.append("R")
     if "otherwiseInsert" in oper:
-        res += "O"
-    return res
+        parts.append("O")
+    return intern("".join(parts))
 
 
 def addOperation(oper):
@@ -272,10 +432,7 @@ def addOperation(oper):
 def is_add_operation(oper):
     """ Answers the question: Is this an add operation ?
     Returns a boolean: True or False"""
-    if len(oper) == 1 and "otherwiseInsert" in oper:
-        return True
-    else:
-        return False
+    return operation(oper) is _OPT_O
 
 
 def deleteOperation(oper):
@@ -285,10 +442,7 @@ def deleteOperation(oper):
 def is_delete_operation(oper):
     """ Answers the question: Is this an delete operation ?
     Returns a boolean: True or False"""
-    if len(oper) == 1 and "match" in oper:
-        return True
-    else:
-        return False
+    return operation(oper) is _OPT_M
 
 
 def is_move_operation(oper):
@@ -296,12 +450,12 @@ def is_move_operation(oper):
     A move operation is defined as a "MR" operation where the "M" and
     "R" objects has different nonzero uriref's but no properties.
     """
-    if len(oper) == 2 and "match" in oper and "replace" in oper:
-        if oper["match"][0].about and oper["replace"][0].about and \
-                len(oper["match"][0]) == 0 and len(
-                oper["replace"][0]) == 0:
-            return True
-    return False
+    if operation(oper) is not _OPT_MR:
+        return False
+    match = oper["match"][0]
+    replace = oper["replace"][0]
+    return bool(match.about and replace.about and
+                len(match) == 0 and len(replace) == 0)
 
 # ----------------------------------------------------------------------------
 
@@ -312,13 +466,14 @@ def about(oper):
 
     - `op`: The operation
     """
-    opt = operation(oper)
     res = []
-    if "M" in opt:
+    if "match" in oper:
         res.append(oper["match"][0].about)
-    if "R" in opt and oper["replace"][0].about:
-        res.append(oper["replace"][0].about)
-    if "O" in opt:
+    if "replace" in oper:
+        uriref = oper["replace"][0].about
+        if uriref:
+            res.append(uriref)
+    if "otherwiseInsert" in oper:
         res.append(oper["otherwiseInsert"][0].about)
     return res
 
@@ -332,9 +487,10 @@ def verify(oper):
     """
     oper.within_restrictions()
 
-    if operation(oper) not in ALLOWEDCONSTRUCTS:
+    optype = operation(oper)
+    if optype not in ALLOWEDCONSTRUCTS:
         raise NotAllowedConstruct("Not an allowed MIRO construct '%s'" %
-                                  operation(oper))
+                                  optype)
 
     return True
 
@@ -344,10 +500,7 @@ def verify(oper):
 def remove_object_type(oper):
     """Is this operation aiming to remove a whole object from the repository?
     """
-    if operation(oper) == "M":
-        if len(oper["match"][0]) == 0:
-            return True
-    return False
+    return operation(oper) is _OPT_M and len(oper["match"][0]) == 0
 
 
 def is_rename_operation(oper):
@@ -355,14 +508,12 @@ def is_rename_operation(oper):
     operation that doesn't change any aspect of the object except its 'name'.
     The name is a URI referens.
     """
-    if operation(oper) == "MR":
-        match = oper["match"][0]
-        replace = oper["replace"][0]
-        if len(match) == 0 and match.about and \
-                len(replace) == 0 and replace.about:
-            return True
-
-    return False
+    if operation(oper) is not _OPT_MR:
+        return False
+    match = oper["match"][0]
+    replace = oper["replace"][0]
+    return bool(len(match) == 0 and match.about and
+                len(replace) == 0 and replace.about)
 
 # ----------------------------------------------------------------------------
 
@@ -452,6 +603,33 @@ True
 >>> b = new_body({"M":p1, "R":p2})
 >>> isRenameOperation(b)
 False
+""",
+            "f": """
+>>> import pyom.ontology.prim_3 as prim
+>>> p1 = prim.Person()
+>>> p1.about = "http://www.mlb.com/players#jeter_derek"
+>>> p2 = prim.Person()
+>>> p2.about = "http://www.mlb.com/players#rivera_mariano"
+>>> args = {"mid": "mid-1", "receiver": "other@example.com", "ReplyTo": "z"}
+>>> msgs = new_messages_bulk([(new_delete_body(p1), args),
+...                           (new_delete_body(p2), None)],
+...                          "me@example.com", "you@example.com")
+>>> len(msgs)
+2
+>>> msgs[0]["createTime"] == msgs[1]["createTime"]
+True
+>>> msgs[0]["mid"] == msgs[1]["mid"]
+False
+>>> print summary(msgs[0])
+mid-1 me@example.com->you@example.com
+>>> print msgs[0]["ReplyTo"][0]
+z
+>>> sorted(args.keys())
+['ReplyTo', 'receiver']
+>>> msg = new_message(new_delete_body(p1), "me@example.com",
+...                   args={"mid": "mid-2"})
+>>> print summary(msg)
+mid-2 me@example.com->
 """}
 
 if __name__ == '__main__':